@@ -33,12 +33,50 @@
 #  sudo systemctl enable adc-daemon --now
 #
 # Command line options:
-# adc-daemon.py -l {0-5}
+# adc-daemon.py -l {0-5} -p {2.2,5.1,7.1} -b {hz}
 # -l log level    -l 5
+# -p PCB version  -p 7.1
+# -b SPI clock    -b 1350000
+#    MCP3008 is rated to 1.35 MHz at 2.7V and 3.6 MHz at 5V
+# -s spidev       -s /dev/spidev0.0
+#    read through the kernel spidev driver, submitting all
+#    8 channel reads in a single ioctl.  The ADC CS line must
+#    be the spidev chip select, e.g. for PCB v7.1 in config.txt
+#      dtoverlay=spi0-1cs,cs0_pin=25
+# -i publish      -i 1.0
+#    sample all channels every interval seconds into shared
+#    memory at /dev/shm/adc-daemon (0 disables, the default)
+# -n samples      -n 16
+#    default number of consecutive reads averaged for each
+#    returned value (1-255, default 1)
+# -t idle timeout -t 60
+#    close client connections idle for this many seconds
+#    (0 keeps them open forever, default 60)
 #
 # Command Format:
-# Valid channel name:
-# 0, 1, 2, 3, 4, 5, 6, 7
+# Requests and responses are single SOCK_SEQPACKET messages.
+# Request is one byte holding the channel number:
+# 0, 1, 2, 3, 4, 5, 6, 7, or 8 for all channels
+# optionally followed by a second byte holding the number
+# of reads (1-255) to average, overriding --samples.
+# Response is the voltage as a little endian 32 bit float,
+# or 8 floats (channels 0-7) for an all channel request.
+# Errors are returned as an ASCII message starting "ERROR".
+# Clients may keep the connection open and send any number
+# of requests; any number of clients may be connected at once.
+# Connections idle longer than the idle timeout are closed.
+#
+# Shared Memory Format (with --publish):
+# /dev/shm/adc-daemon holds, little endian:
+#   offset 0   64 bit sequence number
+#   offset 8   sample time, 64 bit float CLOCK_MONOTONIC seconds
+#   offset 16  publish interval, 64 bit float seconds
+#   offset 24  8 32 bit floats (channels 0-7)
+# The sequence is odd while an update is being written, readers
+# retry until they see the same even sequence before and after
+# reading the sample.  Readers treat samples much older than the
+# publish interval as stale (daemon stopped publishing).
+# The file is replaced, never truncated, when the daemon starts.
 #
 # Logging levels
 # 0 normal and error messages
@@ -74,6 +112,28 @@
 #   sudo /opt/garden/python3/bin/pip3 install adafruit-circuitpython-mcp230xx
 #   sudo /opt/garden/python3/bin/pip3 install adafruit-circuitpython-mcp3xxx
 #
+# v1.1.0 2026/10/14
+# - persistent client connections, newline framed requests
+# - "all" request returns every channel in one response
+#
+# v1.2.0 2026/10/15
+# - SOCK_SEQPACKET socket with single byte requests and
+#   binary float responses
+# - read MCP3008 directly over SPI, holding the bus lock once
+#   per request instead of once per channel
+# - SPI clock raised to 1.35 MHz, configurable with --baudrate
+# - optional spidev reads, all channels in one SPI_IOC_MESSAGE
+# - optional publishing of periodic samples to shared memory
+# - cheaper JSON logging, no stdout copy when run under systemd
+# - serve multiple client connections with selectors
+# - receive requests into a preallocated buffer
+# - optional averaging of multiple reads per value
+# - raw to voltage scale computed once at startup
+# - connecting client pid/uid/gid logged at loglevel 3
+# - idle client connections closed after --idle-timeout
+# - stdout logging skipped only when stdout really is the journal
+# - requests validated up front, exceptions only for ADC failures
+#
 # TODO:
 # - convert linear code to functions
 # - add optional pin configuration to accomodate prototyping
@@ -81,7 +141,13 @@
 
 import os
 import sys
+import ctypes
+import fcntl
+import mmap
+import selectors
+import threading
 import socket
+import struct
 import json
 import time
 import syslog
@@ -92,18 +158,81 @@ from datetime import datetime
 import digitalio
 import signal
 import adafruit_mcp3xxx.mcp3008 as MCP
-from adafruit_mcp3xxx.analog_in import AnalogIn
 
 # --------------------------
 # constants and globals
 # --------------------------
 
-version = "1.0.0"
+version = "1.2.0"
 loglevel = 3
 socket_file = "/tmp/adc-daemon.sock"
+shm_file = "/dev/shm/adc-daemon"
+shm_size = 64
+
+# request code for reading all channels
+ALL_CHANNELS = 8
+
+# reads averaged per value unless the request says otherwise
+default_samples = 1
+
+# receive buffer shared by all connections, requests are
+# handled one at a time by the event loop
+request_buf = bytearray(16)
+request_view = memoryview(request_buf)
+
+# monotonic time of the last request on each client connection
+client_last_seen = {}
+
+# reply waiting for send buffer space, per client connection;
+# no further requests are read from a client until it is sent
+client_pending = {}
+
+# SPI bus, chip select and transfer buffers for MCP3008 reads
+spi_bus = None
+spi_cs = None
+spi_baudrate = 1350000
+spi_tx = bytearray([0x01, 0x00, 0x00])
+spi_rx = bytearray(3)
+ref_voltage = 3.3
+# volts per raw count, same scaling as AnalogIn.voltage
+# (10 bit value shifted to 16 bits)
+voltage_scale = 64 * ref_voltage / 65535
+
+# serializes ADC reads between request handling and publishing
+adc_lock = threading.Lock()
+
+# spidev transfer description, struct spi_ioc_transfer from
+# linux/spi/spidev.h
+class SpiIocTransfer(ctypes.Structure):
+    _fields_ = [
+        ("tx_buf", ctypes.c_uint64),
+        ("rx_buf", ctypes.c_uint64),
+        ("len", ctypes.c_uint32),
+        ("speed_hz", ctypes.c_uint32),
+        ("delay_usecs", ctypes.c_uint16),
+        ("bits_per_word", ctypes.c_uint8),
+        ("cs_change", ctypes.c_uint8),
+        ("tx_nbits", ctypes.c_uint8),
+        ("rx_nbits", ctypes.c_uint8),
+        ("word_delay_usecs", ctypes.c_uint8),
+        ("pad", ctypes.c_uint8),
+    ]
 
-# Global ADC objects
-channels = []
+def spi_ioc_message(n):
+    # _IOW(SPI_IOC_MAGIC, 0, char[SPI_MSGSIZE(n)])
+    return 0x40000000 | ((n * ctypes.sizeof(SpiIocTransfer)) << 16) | (ord('k') << 8)
+
+SPI_IOC_WR_MODE = 0x40016b01
+SPI_IOC_MESSAGE_1 = spi_ioc_message(1)
+SPI_IOC_MESSAGE_8 = spi_ioc_message(8)
+
+# spidev handle and prebuilt transfers, one batch covering
+# channels 0-7 and one single transfer per channel
+spidev_fd = None
+spidev_tx = (ctypes.c_uint8 * 24)()
+spidev_rx = (ctypes.c_uint8 * 24)()
+spidev_all = (SpiIocTransfer * 8)()
+spidev_one = (SpiIocTransfer * 8)()
 
 # --------------------------
 # argument parsing
@@ -125,7 +254,40 @@ def parse_arguments():
         choices=['2.2', '5.1', '7.1'],
         default='7.1',
         help='PCB version (2.2, 5.1, or 7.1)')
-    return parser.parse_args()
+    parser.add_argument(
+        "--baudrate", "-b",
+        type=int,
+        default=1350000,
+        help="SPI clock in Hz (MCP3008 max 1350000 at 2.7V, 3600000 at 5V)"
+    )
+    parser.add_argument(
+        "--spidev", "-s",
+        type=str,
+        default=None,
+        help="Read through a spidev device (e.g. /dev/spidev0.0) instead of GPIO CS"
+    )
+    parser.add_argument(
+        "--publish", "-i",
+        type=float,
+        default=0,
+        help="Publish all channels to shared memory every N seconds (0=off)"
+    )
+    parser.add_argument(
+        "--samples", "-n",
+        type=int,
+        default=1,
+        help="Number of reads averaged for each value (1-255)"
+    )
+    parser.add_argument(
+        "--idle-timeout", "-t",
+        type=float,
+        default=60,
+        help="Close client connections idle for N seconds (0=never)"
+    )
+    args = parser.parse_args()
+    if not 1 <= args.samples <= 255:
+        parser.error("samples must be 1-255")
+    return args
 
 # ----------------------------
 # logging functions
@@ -138,19 +300,31 @@ def openlog(ident=None, logopt=0, facility=syslog.LOG_USER):
 
 openlog()
 
+def stdout_is_journal():
+    # systemd sets JOURNAL_STREAM to the device:inode of the stream
+    # it connects to stdout; the variable alone may be inherited
+    stream = os.environ.get("JOURNAL_STREAM")
+    if not stream:
+        return False
+    try:
+        st = os.fstat(sys.stdout.fileno())
+    except (OSError, ValueError):
+        return False
+    return stream == f"{st.st_dev}:{st.st_ino}"
+
+# under systemd stdout goes to the journal, which already gets
+# every message through syslog
+log_to_stdout = not stdout_is_journal()
+
 def log_message_json(message, level, severity):
-    global loglevel
-    if loglevel >= level:
-        timestamp = datetime.now().isoformat()
-        log_entry = {
-            "timestamp": timestamp,
-            "message": message,
-            "level": level,
-            "severity": severity
-        }
-        json_log = json.dumps(log_entry, separators=(',', ':'))
-        json_log = json_log.replace('\n', ' ').replace('\r', '')
-        syslog.syslog(json_log)
+    if loglevel < level:
+        return
+    # message is the only field that needs JSON escaping
+    json_log = (f'{{"timestamp":"{datetime.now().isoformat()}",'
+                f'"message":{json.dumps(message, separators=(",", ":"))},'
+                f'"level":{level},"severity":"{severity}"}}')
+    syslog.syslog(json_log)
+    if log_to_stdout:
         print(json_log)
 
 # ------------------------------------
@@ -159,94 +333,292 @@ def log_message_json(message, level, severity):
 
 def signal_handler(sig, frame):
     log_message_json("Received termination signal; shutting down.", 2, "info")
-    if os.path.exists(socket_file):
-        os.unlink(socket_file)
+    for path in (socket_file, shm_file):
+        if os.path.exists(path):
+            os.unlink(path)
     sys.exit(0)
 
 signal.signal(signal.SIGTERM, signal_handler)
 signal.signal(signal.SIGINT, signal_handler)
 
+# --------------------------
+# ADC reads
+# --------------------------
+
+def read_raw(channels):
+    with adc_lock:
+        if spidev_fd is not None:
+            return spidev_read_raw(channels)
+        return busio_read_raw(channels)
+
+def busio_read_raw(channels):
+    # read 10 bit single ended values for each channel while
+    # holding the SPI bus lock once; CS is still cycled for each
+    # conversion as the MCP3008 requires
+    while not spi_bus.try_lock():
+        pass
+    try:
+        spi_bus.configure(baudrate=spi_baudrate, polarity=0, phase=0)
+        values = []
+        for channel in channels:
+            spi_tx[1] = 0x80 | (channel << 4)
+            spi_cs.value = False
+            spi_bus.write_readinto(spi_tx, spi_rx)
+            spi_cs.value = True
+            values.append(((spi_rx[1] & 0x03) << 8) | spi_rx[2])
+        return values
+    finally:
+        spi_bus.unlock()
+
+def open_spidev(path):
+    global spidev_fd
+    spidev_fd = os.open(path, os.O_RDWR)
+    # SPI mode 0
+    fcntl.ioctl(spidev_fd, SPI_IOC_WR_MODE, struct.pack('B', 0))
+
+    tx_base = ctypes.addressof(spidev_tx)
+    rx_base = ctypes.addressof(spidev_rx)
+    for channel in range(8):
+        spidev_tx[channel * 3] = 0x01
+        spidev_tx[channel * 3 + 1] = 0x80 | (channel << 4)
+        for xfer in (spidev_all[channel], spidev_one[channel]):
+            xfer.tx_buf = tx_base + channel * 3
+            xfer.rx_buf = rx_base + channel * 3
+            xfer.len = 3
+            xfer.speed_hz = spi_baudrate
+        # release CS between conversions within the batch
+        spidev_all[channel].cs_change = 1 if channel < 7 else 0
+
+def spidev_read_raw(channels):
+    # all channels (range(8)) are submitted as one message
+    if len(channels) == 8:
+        fcntl.ioctl(spidev_fd, SPI_IOC_MESSAGE_8, spidev_all)
+    else:
+        for channel in channels:
+            fcntl.ioctl(spidev_fd, SPI_IOC_MESSAGE_1, spidev_one[channel])
+    return [((spidev_rx[channel * 3 + 1] & 0x03) << 8) | spidev_rx[channel * 3 + 2]
+            for channel in channels]
+
+def read_average(channels, samples):
+    # mean of samples consecutive raw reads of each channel
+    if samples == 1:
+        return read_raw(channels)
+    totals = [0] * len(channels)
+    for _ in range(samples):
+        for i, raw in enumerate(read_raw(channels)):
+            totals[i] += raw
+    return [total / samples for total in totals]
+
+# --------------------------
+# shared memory publishing
+# --------------------------
+
+def open_shm():
+    # replace rather than truncate the file; readers may still have
+    # the old one mapped and would fault on a shrunk mapping
+    if os.path.exists(shm_file):
+        os.unlink(shm_file)
+    fd = os.open(shm_file, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o644)
+    try:
+        os.ftruncate(fd, shm_size)
+        os.fchmod(fd, 0o644)
+        return mmap.mmap(fd, shm_size)
+    finally:
+        os.close(fd)
+
+def publish_loop(shm, interval):
+    seq = 0
+    next_sample = time.monotonic()
+    while True:
+        try:
+            voltages = [raw * voltage_scale for raw in read_average(range(8), default_samples)]
+            # odd sequence tells readers an update is in progress
+            struct.pack_into('<Q', shm, 0, seq + 1)
+            struct.pack_into('<2d8f', shm, 8, time.clock_gettime(time.CLOCK_MONOTONIC),
+                             interval, *voltages)
+            seq += 2
+            struct.pack_into('<Q', shm, 0, seq)
+        except Exception as e:
+            log_message_json({"error": str(e)}, 0, "exception")
+
+        next_sample += interval
+        time.sleep(max(0, next_sample - time.monotonic()))
+
+# --------------------------
+# request handling
+# --------------------------
+
+def handle_request(data, length):
+    # validate with plain comparisons so malformed requests
+    # never raise
+    if length == 1:
+        samples = default_samples
+    elif length == 2 and data[1] > 0:
+        samples = data[1]
+    else:
+        return b"ERROR: Invalid request format"
+    channel = data[0]
+    if channel > ALL_CHANNELS:
+        return b"ERROR: Channel must be 0-7"
+
+    # only ADC read failures are exceptional
+    try:
+        if channel == ALL_CHANNELS:
+            voltages = [raw * voltage_scale for raw in read_average(range(8), samples)]
+        else:
+            voltage = read_average((channel,), samples)[0] * voltage_scale
+    except Exception as e:
+        log_message_json({"error": str(e)}, 1, "exception")
+        return f"ERROR: {str(e)}".encode('utf-8')
+
+    # skip building per request messages unless they are logged
+    if channel == ALL_CHANNELS:
+        if loglevel >= 3:
+            log_message_json(f"All channel voltages: {voltages}", 3, "info")
+        return struct.pack('<8f', *voltages)
+
+    if loglevel >= 3:
+        log_message_json(f"Channel {channel} voltage: {voltage:.4f}V", 3, "info")
+    return struct.pack('<f', voltage)
+
+# --------------------------
+# client connections
+# --------------------------
+
+def accept_client(sel, server):
+    conn, _ = server.accept()
+    conn.setblocking(False)
+    if loglevel >= 3:
+        # log who connected; informational only, any local user
+        # may use the socket
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        pid, uid, gid = struct.unpack('3i', creds)
+        log_message_json(f"Client connected pid {pid} uid {uid} gid {gid}", 3, "info")
+    sel.register(conn, selectors.EVENT_READ, serve_client)
+    client_last_seen[conn] = time.monotonic()
+
+def close_client(sel, conn):
+    sel.unregister(conn)
+    del client_last_seen[conn]
+    client_pending.pop(conn, None)
+    conn.close()
+
+def send_reply(sel, conn, reply):
+    try:
+        conn.send(reply)
+    except BlockingIOError:
+        # client is not reading its replies; hold this one and wait
+        # for the socket to become writable instead of reading more
+        client_pending[conn] = reply
+        sel.modify(conn, selectors.EVENT_WRITE, serve_client)
+        return
+    if conn in client_pending:
+        del client_pending[conn]
+        sel.modify(conn, selectors.EVENT_READ, serve_client)
+
+def serve_client(sel, conn):
+    try:
+        # writable with a held reply, send it and resume reading
+        if conn in client_pending:
+            send_reply(sel, conn, client_pending[conn])
+            return
+
+        # one SOCK_SEQPACKET message is one request
+        try:
+            length = conn.recv_into(request_view)
+        except BlockingIOError:
+            return
+        if length:
+            client_last_seen[conn] = time.monotonic()
+            send_reply(sel, conn, handle_request(request_buf, length))
+            return
+    except OSError as e:
+        log_message_json({"error": str(e)}, 1, "exception")
+
+    # client closed the connection or it failed
+    close_client(sel, conn)
+
+def close_idle_clients(sel, idle_timeout):
+    cutoff = time.monotonic() - idle_timeout
+    for conn in [c for c, seen in client_last_seen.items() if seen < cutoff]:
+        log_message_json("Closing idle client connection", 3, "info")
+        close_client(sel, conn)
+
 # --------------------------
 # daemon main loop
 # --------------------------
 
 def main():
-    global loglevel, channels
+    global loglevel, spi_bus, spi_cs, spi_baudrate, ref_voltage, voltage_scale, default_samples
 
     args = parse_arguments()
     loglevel = args.loglevel
     hwversion = args.hwversion
-
-    # Set CS pin based on hardware version
-    if hwversion in ["2.2", "5.1"]:
-        adccs = digitalio.DigitalInOut(board.D26)
-    elif hwversion == "7.1":
-        adccs = digitalio.DigitalInOut(board.D25)
+    spi_baudrate = args.baudrate
+    default_samples = args.samples
 
     log_message_json(f"Starting ADC daemon for hardware version {hwversion}", 2, "info")
 
     try:
-        # Create SPI bus
-        spi = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
-        
-        # Initialize MCP3008 ADC
-        mcp = MCP.MCP3008(spi, adccs)
-        
-        # Create analog input channels 0-7
-        channels = [
-            AnalogIn(mcp, MCP.P0),
-            AnalogIn(mcp, MCP.P1),
-            AnalogIn(mcp, MCP.P2),
-            AnalogIn(mcp, MCP.P3),
-            AnalogIn(mcp, MCP.P4),
-            AnalogIn(mcp, MCP.P5),
-            AnalogIn(mcp, MCP.P6),
-            AnalogIn(mcp, MCP.P7)
-        ]
-        log_message_json("ADC channels initialized successfully", 3, "info")
+        if args.spidev:
+            # kernel driver owns the bus and chip select
+            open_spidev(args.spidev)
+            log_message_json(f"ADC channels initialized on {args.spidev}, SPI clock {spi_baudrate} Hz", 3, "info")
+        else:
+            # Set CS pin based on hardware version
+            if hwversion in ["2.2", "5.1"]:
+                adccs = digitalio.DigitalInOut(board.D26)
+            elif hwversion == "7.1":
+                adccs = digitalio.DigitalInOut(board.D25)
+
+            # Create SPI bus
+            spi_bus = busio.SPI(clock=board.SCK, MISO=board.MISO, MOSI=board.MOSI)
+
+            # Initialize MCP3008 ADC; the driver sets up the CS pin,
+            # requests then talk to the chip directly over the bus
+            mcp = MCP.MCP3008(spi_bus, adccs, baudrate=spi_baudrate)
+            spi_cs = adccs
+            ref_voltage = mcp.reference_voltage
+            voltage_scale = 64 * ref_voltage / 65535
+            log_message_json(f"ADC channels initialized successfully, SPI clock {spi_baudrate} Hz", 3, "info")
 
     except Exception as e:
         log_message_json({"error": str(e)}, 0, "exception")
         exit(1)
 
+    # Start sampling into shared memory
+    if args.publish > 0:
+        shm = open_shm()
+        threading.Thread(target=publish_loop, args=(shm, args.publish), daemon=True).start()
+        log_message_json(f"Publishing samples to {shm_file} every {args.publish}s", 2, "info")
+
     # Cleanup previous socket file
     if os.path.exists(socket_file):
         os.unlink(socket_file)
 
     # Create Unix Domain Socket
-    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
     server.bind(socket_file)
     os.chmod(socket_file, 0o666)
-    server.listen(5)
+    server.listen(16)
     log_message_json(f"Listening on socket {socket_file}", 2, "info")
 
+    # multiplex the listening socket and all client connections
+    sel = selectors.DefaultSelector()
+    server.setblocking(False)
+    sel.register(server, selectors.EVENT_READ, accept_client)
+
+    # wake at least once a second to close idle clients
+    idle_timeout = args.idle_timeout
+    select_timeout = 1.0 if idle_timeout > 0 else None
+
     while True:
         try:
-            conn, _ = server.accept()
-            with conn:
-                data = conn.recv(1024)
-                if not data:
-                    continue
-                
-                try:
-                    channel_str = data.decode('utf-8').strip()
-                    channel = int(channel_str)
-                    log_message_json(f"Received request for channel {channel}", 3, "info")
-                    
-                    if 0 <= channel <= 7:
-                        voltage = channels[channel].voltage
-                        response = f"{voltage:.4f}"
-                        log_message_json(f"Channel {channel} voltage: {response}V", 3, "info")
-                    else:
-                        response = "ERROR: Channel must be 0-7"
-                        
-                except ValueError:
-                    response = "ERROR: Invalid channel format"
-                except Exception as e:
-                    response = f"ERROR: {str(e)}"
-                
-                conn.sendall(response.encode('utf-8'))
-                
+            for key, _ in sel.select(timeout=select_timeout):
+                key.data(sel, key.fileobj)
+            if idle_timeout > 0:
+                close_idle_clients(sel, idle_timeout)
+
         except Exception as e:
             log_message_json({"error": str(e)}, 0, "exception")
             time.sleep(0.1)
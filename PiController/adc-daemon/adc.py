@@ -11,15 +11,39 @@
 #
 # Usage:
 #  adc.py {channel} --loop --hwversion --verbose
+#         --samples --interval --shm
 #   channel must be 0-7 or "all"
 #   --loop (-l) will display the requested channel(s)
 #          continuously
 #   --hwversion {2.2, 5.1, 7.1} controls the header
 #               displayed to correspond with each
 #               PCB channel layout
+#   --samples (-n) number of reads (1-255) the daemon
+#                  averages for each value
+#   --interval (-i) seconds between loop readings,
+#                   default 1.0
+#   --shm (-s) read the latest samples the daemon publishes
+#              to shared memory instead of querying the
+#              socket (daemon must run with --publish);
+#              cannot be combined with --samples, shared
+#              memory values use the daemon's --samples
 #
 # v1.0 2025/04/16
 # - initial version
+# v1.1 2026/10/14
+# - single persistent daemon connection, newline framed requests
+# - "all" reads every channel in a single daemon request
+# v1.2 2026/10/15
+# - SOCK_SEQPACKET daemon socket, binary request/response
+# - optional read of daemon shared memory samples
+# - loop readings scheduled on a fixed monotonic cadence
+# - each loop line written with a single write
+# - optional daemon side averaging of multiple reads
+# - colorama replaced by ANSI codes, no color when piped
+# - loop rows held as plain lists, formatted in one pass
+# - headers looked up from a table
+# - reconnect once when the daemon has dropped the connection,
+#   failed loop readings shown as -----
 #
 # PiController PCB
 #      V2.2          V5.1        V7.1
@@ -35,51 +59,130 @@
 
 # imports
 import argparse
+import math
+import mmap
 import socket
+import struct
 import sys
 import time
-import array as arr
-import colorama
-from colorama import Fore, Style
 
 # globals
-version = "1.0"
+version = "1.2"
 socket_path = "/tmp/adc-daemon.sock"
+shm_path = "/dev/shm/adc-daemon"
+# attempts to get a consistent sample, 1ms apart
+shm_retries = 100
+# samples older than this many publish intervals are stale
+shm_stale_intervals = 3
 
-def get_adc_voltage(channel):
+# loop mode column headers for each PCB channel layout
+HEADERS = {
+    "2.2": "Day\tWind\tMag\tCh3\tCh4\tCh5\tCh6\t9VFail\n",
+    "5.1": "Mag\tM2\tM3\tDay\tWind\tPwr5\tPress\tMisc\n",
+    "7.1": "Day\tPwr5\tPress\tMisc\tMag\tM2\tM3\tWind\n",
+}
+
+# ANSI highlight, left out when output is not a terminal
+if sys.stdout.isatty():
+    GREEN = "\x1b[32m"
+    RESET = "\x1b[0m"
+else:
+    GREEN = RESET = ""
+
+# request code for reading all channels
+ALL_CHANNELS = 8
+
+# persistent daemon connection, replaced on reconnect
+daemon_sock = None
+
+def connect_daemon():
+    global daemon_sock
+    if daemon_sock is not None:
+        daemon_sock.close()
+    daemon_sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    daemon_sock.connect(socket_path)
+
+def request_voltages(code, count, samples):
+    # sample count byte is only sent when averaging is requested
+    request = bytes([code, samples]) if samples else bytes([code])
+    # the daemon closes idle connections (and restarts); reconnect
+    # once and retry before reporting the error
+    for attempt in range(2):
+        try:
+            daemon_sock.send(request)
+            response = daemon_sock.recv(64)
+            if not response:
+                raise ConnectionError("daemon closed connection")
+            break
+        except OSError:
+            if attempt:
+                raise
+            connect_daemon()
+    if response.startswith(b"ERROR"):
+        raise RuntimeError(response.decode('ascii'))
+    return struct.unpack(f'<{count}f', response)
+
+def get_adc_voltage(channel, samples=None):
     try:
-        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
-            sock.connect(socket_path)
-            sock.sendall(str(channel).encode('ascii'))
-            response = sock.recv(1024).decode('ascii').strip()
-            if response.startswith("ERROR"):
-                raise RuntimeError(response)
-            return float(response)
+        return request_voltages(channel, 1, samples)[0]
     except Exception as e:
         print(f"Communication error: {str(e)}")
         return None
 
-def printheader(hwversion):
-    if hwversion == "2.2":
-        print("Day\tWind\tMag\tCh3\tCh4\tCh5\tCh6\t9VFail")
-    elif hwversion == "5.1":
-        print("Mag\tM2\tM3\tDay\tWind\tPwr5\tPress\tMisc")
-    elif hwversion == "7.1":
-        print("Day\tPwr5\tPress\tMisc\tMag\tM2\tM3\tWind")
-
-
-def printvalue(last: float,current: float):
-    delta = current - last
-    if current > 0:
-      gap = delta / current * 100.0
-    else:
-      gap = 0
+def get_all_adc_voltages(samples=None):
+    try:
+        return list(request_voltages(ALL_CHANNELS, 8, samples))
+    except Exception as e:
+        print(f"Communication error: {str(e)}")
+        return None
+
+def open_shm():
+    with open(shm_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
-    if gap > 10.0:
-        print(Fore.GREEN + '{:.4f}'.format(round(current, 4)), '\t', end='', flush=True)
-        print(Style.RESET_ALL, end='', flush=True)
+def get_shm_voltages(shm):
+    # sequence is odd while the daemon is writing; retry if the
+    # sample changed underneath the read.  A sequence stuck odd
+    # means the daemon died mid update.
+    for _ in range(shm_retries):
+        seq = struct.unpack_from('<Q', shm, 0)[0]
+        if not seq & 1:
+            sampled, interval, *voltages = struct.unpack_from('<2d8f', shm, 8)
+            if struct.unpack_from('<Q', shm, 0)[0] == seq:
+                break
+        time.sleep(0.001)
     else:
-        print('{:.4f}'.format(round(current, 4)), '\t', end='', flush=True)
+        raise RuntimeError("shared memory sample is being updated too long")
+
+    if seq == 0:
+        raise RuntimeError("daemon has not published a sample yet")
+    age = time.clock_gettime(time.CLOCK_MONOTONIC) - sampled
+    if age > shm_stale_intervals * interval:
+        raise RuntimeError(f"shared memory sample is stale ({age:.1f}s old)")
+    return voltages
+
+def get_voltages(shm, channels, samples):
+    # voltages for the selected channels, None on error
+    if shm is not None:
+        try:
+            voltages = get_shm_voltages(shm)
+        except Exception as e:
+            print(f"Communication error: {str(e)}")
+            return None
+        return [voltages[ch] for ch in channels]
+    if len(channels) == 8:
+        return get_all_adc_voltages(samples)
+    voltage = get_adc_voltage(channels[0], samples)
+    return None if voltage is None else [voltage]
+
+def printheader(hwversion):
+    sys.stdout.write(HEADERS[hwversion])
+
+
+def formatvalue(last: float, current: float):
+    gap = (current - last) / current * 100.0 if current > 0 else 0.0
+    value = f'{current:.4f}'
+    return GREEN + value + RESET if gap > 10.0 else value
 
 
 def read_and_print():
@@ -108,14 +211,27 @@ def main():
         choices=["2.2","5.1","7.1"],
         help='PCB version (2.2, 5.1, or 7.1)'
     )
+    parser.add_argument(
+        '--samples', '-n',
+        type=int, default=None,
+        help='Number of reads the daemon averages for each value (1-255)'
+    )
+    parser.add_argument('--interval', '-i', type=float, default=1.0, help='Seconds between loop readings')
+    parser.add_argument('--shm', '-s', action='store_true', help='Read daemon shared memory samples')
 
     args = parser.parse_args()
+    if args.samples is not None and not 1 <= args.samples <= 255:
+        parser.error("samples must be 1-255")
+    if args.samples is not None and args.shm:
+        parser.error("--samples cannot be used with --shm, the daemon --samples setting applies")
+    if args.interval <= 0:
+        parser.error("interval must be greater than 0")
     hwversion = args.hwversion
     verbose = args.verbose
 
     if verbose:
-        print(Fore.GREEN + "ADC Display")
-        print(Style.RESET_ALL)
+        print(GREEN + "ADC Display")
+        print(RESET)
 
 
     # Validate channel argument
@@ -131,11 +247,27 @@ def main():
             print("Error: Channel must be 0-7 or 'all'.")
             sys.exit(1)
 
+    # open one connection to the daemon (or its shared memory)
+    # for all requests
+    shm = None
+    try:
+        if args.shm:
+            shm = open_shm()
+        else:
+            connect_daemon()
+    except OSError as e:
+        print(f"Communication error: {str(e)}")
+        sys.exit(1)
+
     if args.loop:
 
         linecount = 0
-        lastreading = arr.array('d',[0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
-        thisreading = arr.array('d',[0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0])
+        # readings for the selected channels, in channel order
+        lastreading = [0.0] * len(channels)
+
+        # schedule against fixed deadlines so time spent reading
+        # and printing does not stretch the interval
+        next_reading = time.monotonic()
 
         try:
             while True:
@@ -143,27 +275,38 @@ def main():
                 if (linecount % 20) == 0 and args.channel == "all":
                     printheader(hwversion)
             
-                # cycle through all selected channels
-                for current_channel in channels:
-                    # get channel voltage from daemon
-                    thisreading[current_channel] = get_adc_voltage(current_channel)
-                    # display value
-                    printvalue(lastreading[current_channel],thisreading[current_channel])
-                    # update last value
-                    lastreading[current_channel] = thisreading[current_channel]
-
-                # terminate line and inc line count
-                print("")
+                # get selected channel voltages from daemon in one request
+                voltages = get_voltages(shm, channels, args.samples)
+                if voltages is None:
+                    # mark the failed reading rather than repeating the last row
+                    cells = ["-----"] * len(channels)
+                else:
+                    # format the whole row in one pass, it becomes the last row
+                    cells = [formatvalue(last, current) for last, current in zip(lastreading, voltages)]
+                    lastreading = voltages
+
+                # write the whole line at once and inc line count
+                sys.stdout.write('\t'.join(cells) + '\n')
+                sys.stdout.flush()
                 linecount+=1
-                time.sleep(1)
+                next_reading += args.interval
+                now = time.monotonic()
+                if next_reading < now:
+                    # overran (slow read, suspend); skip the missed
+                    # readings rather than firing them back to back
+                    next_reading += math.ceil((now - next_reading) / args.interval) * args.interval
+                time.sleep(next_reading - now)
 
         except KeyboardInterrupt:
             print("\nExiting loop.")
+        finally:
+            (shm or daemon_sock).close()
     else:
         # display value for selected channel(s)
-        for ch in channels:
-            # get voltage
-            voltage = get_adc_voltage(ch)
+        voltages = get_voltages(shm, channels, args.samples)
+        if voltages is None:
+            voltages = [None] * len(channels)
+        for ch, voltage in zip(channels, voltages):
             if voltage is not None:
                 if args.verbose:
                     print(f"Channel {ch} voltage: {voltage:.4f} V")
@@ -171,6 +314,7 @@ def main():
                     print(f"{voltage:.4f}")
             else:
                 print(f"Error reading channel {ch}")
+        (shm or daemon_sock).close()
 
 if __name__ == "__main__":
     main()